@@ -1,84 +1,158 @@
+import hashlib
+import re
+
 import streamlit as st
 import pandas as pd
-
-def preprocess_product(row, columns, ignore_prefix):
-    description = row.get(columns['description'], '')
-    if pd.notnull(description) and description.startswith(ignore_prefix):
-        description = description[len(ignore_prefix):]
-    return f"{row.get(columns['name'], '')} {description} {row.get(columns['package_qty'], '')} ({str(row.get(columns['form'], '')).strip().lower()})"
-
-def calculate_quantity_to_order(row, target_months):
-    avg_dispensed = row['total_units_past_6_months'] / (6 / target_months)
-    max_dispensed = max(row['total_units_past_2_months'], avg_dispensed)
-    target_qty = row['target_qty_on_hand_override'] if pd.notnull(row['target_qty_on_hand_override']) else max_dispensed
-    return max(0, target_qty - row['on_hand'])
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+
+# Columns (after standardize_columns) used to build the product key for each upload
+PRODUCT_COLUMNS = {
+    'meds_on_hand': {'name': 'generic_name', 'description': 'description', 'package_qty': 'package_qty', 'form': 'form'},
+    'products_on_hand': {'name': 'brand', 'description': 'description', 'package_qty': 'package_qty', 'form': 'units'},
+    'dispensed_past_2_months': {'name': 'generic', 'description': 'qty_x_form', 'package_qty': 'containers', 'form': 'containers'},
+    'dispensed_past_6_months': {'name': 'generic', 'description': 'qty_x_form', 'package_qty': 'containers', 'form': 'containers'},
+}
+
+# Column holding the unit count in each upload
+QUANTITY_COLUMNS = {
+    'meds_on_hand': 'containers',
+    'products_on_hand': 'on_hand',
+    'dispensed_past_2_months': 'containers',
+    'dispensed_past_6_months': 'containers',
+}
+
+# Only these columns are parsed from each upload
+NEEDED_COLUMNS = {
+    source: {*columns.values(), QUANTITY_COLUMNS[source]} for source, columns in PRODUCT_COLUMNS.items()
+}
+
+def build_product(df, name, description, package_qty, form, ignore_prefix='1 x '):
+    def text(column):
+        # An export without the column contributes empty strings, like the old row.get(column, '')
+        if column not in df.columns:
+            return pa.nulls(len(df), pa.string())
+        return pa.array(df[column], from_pandas=True).cast(pa.string())
+
+    # `form` is already stripped and lowercased by load_upload
+    desc = pc.replace_substring_regex(text(description), '^' + re.escape(ignore_prefix), '')
+    product = pc.binary_join_element_wise(
+        text(name), ' ', desc, ' ', text(package_qty), ' (', text(form), ')', '', null_handling='replace')
+    return pd.Series(product, index=df.index, dtype=pd.ArrowDtype(pa.string()))
+
+def index_by_product(df, column, name):
+    # Re-label the one column instead of set_index on the whole frame, which copies every column
+    return df[column].set_axis(pd.Index(df['product'])).to_frame(name)
 
 def standardize_columns(df):
     df.columns = df.columns.str.lower().str.replace(' ', '_')
     return df
 
+def select_columns(names, needed):
+    return [c for c in names if c.lower().replace(' ', '_') in needed]
+
+def read_csv_fast(f, needed):
+    # The pyarrow engine only takes usecols as a list, so match the header against the standardized names first
+    header = pd.read_csv(f, nrows=0).columns
+    f.seek(0)
+    return pd.read_csv(f, engine='pyarrow', dtype_backend='pyarrow', usecols=select_columns(header, needed))
+
+def read_any(f, needed):
+    if f.name.lower().endswith('.parquet'):
+        columns = select_columns(pq.read_schema(f).names, needed)
+        f.seek(0)
+        return pd.read_parquet(f, columns=columns, dtype_backend='pyarrow')
+    return read_csv_fast(f, needed)
+
+@st.cache_data(show_spinner=False)
+def load_upload(uploaded, source):
+    # The digest keys combine_data exactly; Streamlit only samples large DataFrames when hashing them
+    digest = hashlib.sha256(uploaded.getvalue()).hexdigest()
+    df = standardize_columns(read_any(uploaded, NEEDED_COLUMNS[source]))
+    # Normalize the form text once per upload; the dispensed exports reuse their numeric count column as form
+    form = PRODUCT_COLUMNS[source]['form']
+    if form in df.columns and form != QUANTITY_COLUMNS[source]:
+        df[form] = df[form].astype('string').str.strip().str.lower()
+    return df, digest
+
+@st.cache_data(show_spinner=False)
+def combine_data(upload_digests, _meds_on_hand, _products_on_hand, _dispensed_2_months, _dispensed_6_months):
+    # The DataFrame arguments are skipped by the cache hasher; upload_digests identifies them
+
+    # Preprocess Products
+    _meds_on_hand['product'] = build_product(_meds_on_hand, **PRODUCT_COLUMNS['meds_on_hand'])
+    _products_on_hand['product'] = build_product(_products_on_hand, **PRODUCT_COLUMNS['products_on_hand'])
+    _dispensed_2_months['product'] = build_product(_dispensed_2_months, **PRODUCT_COLUMNS['dispensed_past_2_months'])
+    _dispensed_6_months['product'] = build_product(_dispensed_6_months, **PRODUCT_COLUMNS['dispensed_past_6_months'])
+
+    # Share one category set across frames so the joins hash the small categories table
+    frames = [_meds_on_hand, _products_on_hand, _dispensed_2_months, _dispensed_6_months]
+    categories = union_categoricals(
+        [df['product'].astype('category') for df in frames], sort_categories=True).categories
+    for df in frames:
+        df['product'] = pd.Categorical(df['product'], categories=categories)
+
+    # Merge on product
+    d2 = index_by_product(_dispensed_2_months, QUANTITY_COLUMNS['dispensed_past_2_months'], 'total_units_past_2_months')
+    d6 = index_by_product(_dispensed_6_months, QUANTITY_COLUMNS['dispensed_past_6_months'], 'total_units_past_6_months')
+    ph = index_by_product(_products_on_hand, QUANTITY_COLUMNS['products_on_hand'], 'on_hand')
+    mh = index_by_product(_meds_on_hand, QUANTITY_COLUMNS['meds_on_hand'], 'on_hand_meds')
+    combined_data = d2.join(d6, how='outer').join([ph, mh], how='left').reset_index()
+
+    # Resolve potential conflicts in `on_hand`
+    combined_data['on_hand'] = combined_data['on_hand'].fillna(combined_data.pop('on_hand_meds'))
+
+    # Debug unmatched products
+    unmatched_idx = mh.index.difference(combined_data['product'])
+    unmatched_products = mh.loc[unmatched_idx].rename(columns={'on_hand_meds': 'on_hand'}).reset_index()
+    return combined_data, unmatched_products
+
 def main():
     st.title("Medication Order Calculator")
     st.markdown("This app helps calculate the amount of each medication and product to order based on usage and current inventory.")
 
+    st.caption("Uploads can be CSV or Parquet. Parquet loads much faster, so exports that are reused "
+               "are worth converting once, e.g. with `pd.read_csv(path).to_parquet(path_parquet)`.")
+
     target_months = st.slider("Select Target Months On Hand", 1, 12, 2)
 
     uploaded_files = {
-        'meds_on_hand': st.file_uploader("Upload Meds on Hand CSV", type="csv"),
-        'products_on_hand': st.file_uploader("Upload Products on Hand CSV", type="csv"),
-        'dispensed_past_2_months': st.file_uploader("Upload Dispensed Past 2 Months CSV", type="csv"),
-        'dispensed_past_6_months': st.file_uploader("Upload Dispensed Past 6 Months CSV", type="csv")
+        'meds_on_hand': st.file_uploader("Upload Meds on Hand CSV or Parquet", type=["csv", "parquet"]),
+        'products_on_hand': st.file_uploader("Upload Products on Hand CSV or Parquet", type=["csv", "parquet"]),
+        'dispensed_past_2_months': st.file_uploader("Upload Dispensed Past 2 Months CSV or Parquet", type=["csv", "parquet"]),
+        'dispensed_past_6_months': st.file_uploader("Upload Dispensed Past 6 Months CSV or Parquet", type=["csv", "parquet"])
     }
 
     if all(uploaded_files.values()):
-        # Read and standardize column names
-        meds_on_hand = standardize_columns(pd.read_csv(uploaded_files['meds_on_hand']))
-        products_on_hand = standardize_columns(pd.read_csv(uploaded_files['products_on_hand']))
-        dispensed_2_months = standardize_columns(pd.read_csv(uploaded_files['dispensed_past_2_months']))
-        dispensed_6_months = standardize_columns(pd.read_csv(uploaded_files['dispensed_past_6_months']))
-
-        # Preprocess Products
-        meds_on_hand['product'] = meds_on_hand.apply(preprocess_product, axis=1, 
-            columns={'name': 'generic_name', 'description': 'description', 'package_qty': 'package_qty', 'form': 'form'}, ignore_prefix='1 x ')
-
-        products_on_hand['product'] = products_on_hand.apply(preprocess_product, axis=1, 
-            columns={'name': 'brand', 'description': 'description', 'package_qty': 'package_qty', 'form': 'units'}, ignore_prefix='1 x ')
-
-        dispensed_2_months['product'] = dispensed_2_months.apply(lambda row: preprocess_product(row, 
-            {'name': 'generic', 'description': 'qty_x_form', 'package_qty': 'containers', 'form': 'containers'}, ignore_prefix='1 x '), axis=1)
-
-        dispensed_6_months['product'] = dispensed_6_months.apply(lambda row: preprocess_product(row, 
-            {'name': 'generic', 'description': 'qty_x_form', 'package_qty': 'containers', 'form': 'containers'}, ignore_prefix='1 x '), axis=1)
-
-        # Rename for consistency
-        dispensed_2_months = dispensed_2_months.rename(columns={'containers': 'total_units_past_2_months'})
-        dispensed_6_months = dispensed_6_months.rename(columns={'containers': 'total_units_past_6_months'})
-        meds_on_hand = meds_on_hand.rename(columns={'containers': 'on_hand'})
-
-        # Merge and calculate quantities
-        combined_data = pd.merge(
-            dispensed_2_months[['product', 'total_units_past_2_months']], 
-            dispensed_6_months[['product', 'total_units_past_6_months']], 
-            on='product', 
-            how='outer'
-        )
-        combined_data = pd.merge(combined_data, products_on_hand[['product', 'on_hand']], on='product', how='left')
-        combined_data = pd.merge(combined_data, meds_on_hand[['product', 'on_hand']], on='product', how='left', suffixes=('', '_meds'))
-
-        # Resolve potential conflicts in `on_hand`
-        combined_data['on_hand'] = combined_data['on_hand'].combine_first(combined_data['on_hand_meds'])
-        combined_data.drop(columns=['on_hand_meds'], inplace=True)
-
-        # Debug unmatched products
-        unmatched_products = meds_on_hand[~meds_on_hand['product'].isin(combined_data['product'])]
+        # Read and standardize column names (cached per uploaded file)
+        meds_on_hand, meds_digest = load_upload(uploaded_files['meds_on_hand'], 'meds_on_hand')
+        products_on_hand, products_digest = load_upload(uploaded_files['products_on_hand'], 'products_on_hand')
+        dispensed_2_months, d2_digest = load_upload(uploaded_files['dispensed_past_2_months'], 'dispensed_past_2_months')
+        dispensed_6_months, d6_digest = load_upload(uploaded_files['dispensed_past_6_months'], 'dispensed_past_6_months')
+
+        combined_data, unmatched_products = combine_data(
+            (meds_digest, products_digest, d2_digest, d6_digest),
+            meds_on_hand, products_on_hand, dispensed_2_months, dispensed_6_months)
+
         if not unmatched_products.empty:
-            st.write("Unmatched Products in Meds on Hand:", unmatched_products[['product', 'on_hand']])
+            with st.expander("Debug: unmatched products"):
+                if st.checkbox("Show unmatched products in Meds on Hand"):
+                    st.write("Unmatched Products in Meds on Hand:", unmatched_products)
 
         # Add editable column for target overrides
         if 'target_qty_on_hand_override' not in combined_data.columns:
-            combined_data['target_qty_on_hand_override'] = None
+            combined_data['target_qty_on_hand_override'] = np.full(len(combined_data), np.nan, dtype='float64')
 
-        combined_data['target_qty_on_hand_override'] = st.data_editor(combined_data['target_qty_on_hand_override'])
+        # Batch edits in a form; the editor returns the last submitted overrides on every rerun
+        with st.form('edit'):
+            overrides = st.data_editor(
+                combined_data['target_qty_on_hand_override'],
+                column_config={'target_qty_on_hand_override': st.column_config.NumberColumn()})
+            st.form_submit_button('Recalculate')
+        combined_data['target_qty_on_hand_override'] = overrides
 
         # Check for required columns before calculating
         required_columns = ['total_units_past_6_months', 'total_units_past_2_months', 'on_hand']
@@ -87,7 +161,17 @@ def main():
             st.error(f"Missing required columns for calculation: {missing_columns}")
             return
 
-        combined_data['qty_to_order'] = combined_data.apply(calculate_quantity_to_order, axis=1, target_months=target_months)
+        # Pull plain float64 arrays out of the (possibly Arrow-backed) columns so the math stays in NumPy
+        a6 = combined_data['total_units_past_6_months'].to_numpy(dtype='float64', na_value=0)
+        a2 = combined_data['total_units_past_2_months'].to_numpy(dtype='float64', na_value=0)
+        ov = combined_data['target_qty_on_hand_override'].to_numpy(dtype='float64', na_value=np.nan)
+        oh = combined_data['on_hand'].to_numpy(dtype='float64', na_value=np.nan)
+
+        # Scale the 6-month total to the target window once, as a multiplier
+        k = target_months / 6.0
+        mx = np.maximum(a2, a6 * k)
+        tgt = np.where(np.isnan(ov), mx, ov)
+        combined_data['qty_to_order'] = np.fmax(0, tgt - oh)
 
         # Display results
         st.write("Calculated Quantities to Order:")
@@ -95,8 +179,12 @@ def main():
                                     'total_units_past_6_months', 'on_hand', 'target_qty_on_hand_override']])
 
         # Download Option
-        csv = combined_data.to_csv(index=False)
-        st.download_button("Download Results", csv, "order_quantities.csv", "text/csv")
+        # Callables defer encoding until the user clicks, instead of on every rerun
+        st.download_button("Download Results", lambda: combined_data.to_csv(index=False),
+                           "order_quantities.csv", "text/csv")
+        st.download_button("Download Results (Parquet)",
+                           lambda: combined_data.to_parquet(engine='pyarrow', compression='zstd', index=False),
+                           "order_quantities.parquet", "application/vnd.apache.parquet")
 
 if __name__ == '__main__':
     main()